@@ -0,0 +1,639 @@
+'''
+Benchmark and regression check for the surface/volume post-processing path.
+
+Synthetic inputs are built from the spheres in utilities/standard_mesh_atlases
+(random CIFTI map sets with a cartX/cartY retinotopy pair, inferred maps on
+the subject's native mesh, and small NIfTI volumes), so no real gear run is
+needed. Two kinds of stage are timed:
+
+    make_fsaverage.pseudo_hemi_average, make_fsaverage.cartesian_to_polar,
+    cifti_to_freesurfer.average_hemispheres
+        The per-vertex numeric work of the conversion scripts, run in process
+        on every requested mesh (32k/59k/164k fs_LR, fsaverage4-6, fsaverage).
+
+    make_fsaverage, cifti_to_freesurfer, interpolate_cifti, plot_maps,
+    plot_cifti_maps
+        The scripts themselves, run as a subprocess the same way mainWrapper
+        calls them. The conversion scripts are hard coded to the 32k fs_LR
+        mesh, so only plot_maps is swept over resolutions (volume sizes).
+        Stages that need an HCP subject, Connectome Workbench or FreeSurfer are
+        skipped unless the matching path is given.
+
+Each stage is timed at several map counts (best of --repeats) and its peak
+memory is recorded. Results are written to --output and compared against
+--baseline, flagging runs that got slower or bigger by more than --tolerance.
+Timings depend on the machine, so the baseline is kept wherever the
+benchmark is run rather than in the repository.
+
+Every output of the 4-map set (R2, the cartX/cartY pair and one filler map,
+so the cartesian code paths are covered) is also compared against the golden
+outputs in --golden, so that faster implementations of these stages can be
+checked against the current ones. The golden set is always made with
+GOLDEN_SEED whatever --seed is. Outputs that go missing or appear under new
+names count as mismatches, and a stage and mesh with no golden outputs is
+reported as not checked. benchmark_golden.npz in this folder holds the
+outputs of the in-process stages on the 32k fs_LR and fsaverage4 meshes.
+The exit status is 1 if any regression, golden mismatch or failed script
+was found.
+
+Usage:
+    python3.7 benchmark_postprocessing.py --update-baseline --golden my_golden.npz
+    python3.7 benchmark_postprocessing.py --hcp-subject /path/to/HCP/100610 \\
+        --workbench /path/to/wb_command --stages make_fsaverage,plot_cifti_maps
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import zipfile
+import subprocess
+import tracemalloc
+import numpy as np
+import nibabel as nb
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+standard_mesh_atlases_folder = os.path.join(code_dir, 'utilities', 'standard_mesh_atlases')
+
+# Left and right spheres of each mesh, relative to standard_mesh_atlases_folder
+MESHES = {
+    '32k_fs_LR': ('L.sphere.32k_fs_LR.surf.gii', 'R.sphere.32k_fs_LR.surf.gii'),
+    '59k_fs_LR': ('L.sphere.59k_fs_LR.surf.gii', 'R.sphere.59k_fs_LR.surf.gii'),
+    '164k_fs_LR': ('fsaverage.L_LR.spherical_std.164k_fs_LR.surf.gii', 'fsaverage.R_LR.spherical_std.164k_fs_LR.surf.gii'),
+    'fsaverage4': ('resample_fsaverage/fsaverage4_std_sphere.L.3k_fsavg_L.surf.gii', 'resample_fsaverage/fsaverage4_std_sphere.R.3k_fsavg_R.surf.gii'),
+    'fsaverage5': ('resample_fsaverage/fsaverage5_std_sphere.L.10k_fsavg_L.surf.gii', 'resample_fsaverage/fsaverage5_std_sphere.R.10k_fsavg_R.surf.gii'),
+    'fsaverage6': ('resample_fsaverage/fsaverage6_std_sphere.L.41k_fsavg_L.surf.gii', 'resample_fsaverage/fsaverage6_std_sphere.R.41k_fsavg_R.surf.gii'),
+    'fsaverage': ('resample_fsaverage/fsaverage_std_sphere.L.164k_fsavg_L.surf.gii', 'resample_fsaverage/fsaverage_std_sphere.R.164k_fsavg_R.surf.gii'),
+    }
+
+# HCP atlas ROIs excluding the medial wall, and the total grayordinate count
+# of a dense file on the mesh (cortex plus subcortical voxels)
+ATLAS_ROIS = {
+    '32k_fs_LR': ('L.atlasroi.32k_fs_LR.shape.gii', 'R.atlasroi.32k_fs_LR.shape.gii'),
+    '59k_fs_LR': ('L.atlasroi.59k_fs_LR.shape.gii', 'R.atlasroi.59k_fs_LR.shape.gii'),
+    }
+GRAYORDINATES = {'32k_fs_LR': 91282, '59k_fs_LR': 170494}
+
+KERNEL_STAGES = ['make_fsaverage.pseudo_hemi_average', 'make_fsaverage.cartesian_to_polar',
+                 'cifti_to_freesurfer.average_hemispheres']
+SCRIPT_STAGES = ['make_fsaverage', 'cifti_to_freesurfer', 'interpolate_cifti', 'plot_maps', 'plot_cifti_maps']
+
+# Map count whose outputs are checked against the golden ones. Always run,
+# since it is the smallest set with the cartX/cartY pair. Its inputs are
+# always made with GOLDEN_SEED so that they match the golden outputs.
+GOLDEN_MAP_COUNT = 4
+GOLDEN_SEED = 0
+
+# Name used for the synthetic subject in map file names
+SUBJECT = 'synthetic'
+
+# Maps produced per hemisphere by the Bayesian fit and read by interpolate_cifti
+INFERRED_MAPS = ['angle', 'eccen', 'sigma', 'varea', 'cmf']
+
+
+############################### Synthetic inputs #########################################
+
+_spheres = {}
+
+def load_sphere(mesh):
+
+    # Vertex coordinates of the left and right sphere, scaled to unit length
+    if mesh not in _spheres:
+        coords = []
+        for sphere in MESHES[mesh]:
+            xyz = nb.load(os.path.join(standard_mesh_atlases_folder, sphere)).darrays[0].data.astype(np.float64)
+            coords.append(xyz / np.linalg.norm(xyz, axis=1)[:, None])
+        _spheres[mesh] = tuple(coords)
+    return _spheres[mesh]
+
+
+def load_atlas_roi(mesh):
+
+    # Boolean masks of the left and right vertices that carry grayordinates
+    return tuple(nb.load(os.path.join(standard_mesh_atlases_folder, roi)).darrays[0].data > 0
+                 for roi in ATLAS_ROIS[mesh])
+
+
+def map_fields(n_maps):
+
+    # Every set has an R2 map, then the retinotopy pair, then filler maps
+    fields = ['R2', 'cartX', 'cartY'][:n_maps]
+    return fields + ['synth%02d' % i for i in range(n_maps - len(fields))]
+
+
+def synthetic_maps(mesh, n_maps, seed):
+
+    # Returns [(field, left, right)]. The cartesian maps vary smoothly over the
+    # sphere like a real retinotopic map; the others are uniform noise.
+    (left_coords, right_coords) = load_sphere(mesh)
+    maps = []
+    for idx, field in enumerate(map_fields(n_maps)):
+        if field in ('cartX', 'cartY'):
+            axis = 1 if field == 'cartX' else 2
+            left = 10 * left_coords[:, axis]
+            right = 10 * right_coords[:, axis]
+        else:
+            rng = np.random.RandomState(seed + idx)
+            left = rng.uniform(0, 1, len(left_coords))
+            right = rng.uniform(0, 1, len(right_coords))
+        maps.append((field, left.astype(np.float32), right.astype(np.float32)))
+    return maps
+
+
+def save_cifti(path, mesh, left, right):
+
+    # Single-timepoint dense series laid out like an HCP grayordinate file:
+    # the cortex models cover only the vertices in the fs_LR atlas ROI (no
+    # medial wall) and a subcortical block makes up the rest of the
+    # grayordinates, since ny.hcp.cifti_split infers the mesh from the total.
+    if mesh not in ATLAS_ROIS:
+        raise ValueError('No atlas ROI for %s, CIFTI maps need one of %s' % (mesh, ', '.join(ATLAS_ROIS)))
+    (left_roi, right_roi), n_grayordinates = load_atlas_roi(mesh), GRAYORDINATES[mesh]
+    brain_models = (nb.cifti2.BrainModelAxis.from_mask(left_roi, name='CORTEX_LEFT') +
+                    nb.cifti2.BrainModelAxis.from_mask(right_roi, name='CORTEX_RIGHT'))
+    n_voxels = n_grayordinates - left_roi.sum() - right_roi.sum()
+    size = int(np.ceil(n_voxels ** (1 / 3.)))
+    mask = (np.arange(size ** 3) < n_voxels).reshape(size, size, size)
+    brain_models = brain_models + nb.cifti2.BrainModelAxis.from_mask(mask, name='THALAMUS_LEFT', affine=np.diag([2., 2., 2., 1.]))
+    data = [left[left_roi], right[right_roi], np.linspace(0, 1, n_voxels)]
+    series = nb.cifti2.SeriesAxis(start=0, step=1, size=1)
+    header = nb.cifti2.Cifti2Header.from_axes((series, brain_models))
+    image = nb.Cifti2Image(np.concatenate(data)[None, :].astype(np.float32), header)
+    image.nifti_header.set_intent('NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES')
+    nb.save(image, path)
+
+
+def write_cifti_maps(folder, mesh, n_maps, seed):
+
+    os.makedirs(folder)
+    paths = []
+    for field, left, right in synthetic_maps(mesh, n_maps, seed):
+        paths.append(os.path.join(folder, '%s_%s_map.dtseries.nii' % (SUBJECT, field)))
+        save_cifti(paths[-1], mesh, left, right)
+    return paths
+
+
+def write_volumes(folder, size, n_maps, seed):
+
+    # An anatomy-like template (a bright ball) and n random stat maps on the
+    # same 2mm grid, so plot_maps does not need to resample with flirt
+    os.makedirs(folder)
+    affine = np.diag([2., 2., 2., 1.])
+    grid = np.indices((size, size, size)) - (size - 1) / 2.
+    template = (np.sqrt((grid ** 2).sum(axis=0)) < size / 2.5) * 100.
+    template_path = os.path.join(folder, 'template.nii.gz')
+    nb.save(nb.Nifti1Image(template.astype(np.float32), affine), template_path)
+    map_paths = []
+    for idx in range(n_maps):
+        rng = np.random.RandomState(seed + idx)
+        map_paths.append(os.path.join(folder, '%s_synth%02d_map.nii.gz' % (SUBJECT, idx)))
+        nb.save(nb.Nifti1Image(rng.uniform(0, 1, (size, size, size)).astype(np.float32), affine), map_paths[-1])
+    return template_path, map_paths
+
+
+def write_inferred_maps(folder, hcp_subject, seed):
+
+    # The Bayesian fit outputs live on the subject's native mesh
+    import neuropythy as ny
+    sub = ny.hcp_subject(hcp_subject, default_alignment='FS')
+    os.makedirs(folder)
+    rng = np.random.RandomState(seed)
+    for hemi in ['lh', 'rh']:
+        n_vertices = sub.hemis[hemi].vertex_count
+        values = {'angle': rng.uniform(-180, 180, n_vertices), 'eccen': rng.uniform(0, 20, n_vertices),
+                  'sigma': rng.uniform(0.5, 5, n_vertices), 'varea': rng.randint(0, 4, n_vertices),
+                  'cmf': rng.uniform(0, 10, n_vertices)}
+        for name in INFERRED_MAPS:
+            data = values[name].astype(np.float32).reshape(-1, 1, 1)
+            nb.save(nb.MGHImage(data, np.eye(4)), os.path.join(folder, '%s.%s_inferred_%s.mgz' % (hemi, SUBJECT, name)))
+
+
+################################### Measurement ##########################################
+
+def measure_in_process(func, repeats):
+
+    # Best of the timed repeats, then one more pass under tracemalloc for the
+    # peak memory since tracing slows down the per-vertex loops
+    seconds = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(seconds), peak / 1024. ** 2, result
+
+
+def run_script(python, script, args, log_path):
+
+    # Run one script the way mainWrapper does and return its wall time and
+    # peak resident memory (including the external tools it waited for)
+    with open(log_path, 'a') as log:
+        log.write('\n$ %s %s\n' % (script, ' '.join(args)))
+        log.flush()
+        start = time.perf_counter()
+        proc = subprocess.Popen([python, os.path.join(code_dir, script)] + args, stdout=log, stderr=subprocess.STDOUT)
+        (pid, status, usage) = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if proc.returncode != 0:
+        raise RuntimeError('%s exited with status %d, see %s' % (script, proc.returncode, log_path))
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    scale = 1024. ** 2 if sys.platform == 'darwin' else 1024.
+    return seconds, usage.ru_maxrss / scale
+
+
+def summarize_outputs(folders):
+
+    # Arrays that stand in for the outputs when comparing against golden ones.
+    # Images are reduced to the mean intensity of each frame, or of each
+    # channel for the png files inside a zip.
+    summary = {}
+    for folder in folders:
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            key = '%s:%s' % (os.path.basename(folder), name)
+            if name.endswith(('.mgz', '.nii', '.nii.gz', '.gii')):
+                image = nb.load(path)
+                if isinstance(image, nb.GiftiImage):
+                    summary[key] = image.darrays[0].data
+                else:
+                    summary[key] = np.asarray(image.dataobj)
+            elif name.endswith('.gif'):
+                import imageio
+                summary[key] = np.array([frame.mean() for frame in imageio.mimread(path)])
+            elif name.endswith('.zip'):
+                import imageio
+                with zipfile.ZipFile(path) as archive:
+                    for member in sorted(archive.namelist()):
+                        if member.endswith('.png'):
+                            image = np.asarray(imageio.imread(archive.read(member)), dtype=np.float64)
+                            summary['%s:%s' % (key, member)] = image.reshape(-1, image.shape[-1] if image.ndim == 3 else 1).mean(axis=0)
+    return summary
+
+
+##################################### Stages #############################################
+
+def kernel_stage(stage, mesh, n_maps, seed):
+
+    # Returns a function running the stage over a synthetic map set, the
+    # number of maps it processes and a label for each result it returns
+    if stage == 'make_fsaverage.pseudo_hemi_average':
+        from make_fsaverage import pseudo_hemi_average
+        maps = synthetic_maps(mesh, n_maps, seed)
+        def func():
+            return [pseudo_hemi_average(left, right, negate=field == 'cartX') for field, left, right in maps]
+        return func, n_maps, map_fields(n_maps)
+    if stage == 'make_fsaverage.cartesian_to_polar':
+        # Converts both hemispheres of one cartX/cartY pair
+        from make_fsaverage import cartesian_to_polar
+        (_, left_x, right_x), (_, left_y, right_y) = synthetic_maps(mesh, 3, seed)[1:]
+        def func():
+            return [cartesian_to_polar(left_x, left_y), cartesian_to_polar(right_x, right_y)]
+        return func, 1, ['L', 'R']
+    if stage == 'cifti_to_freesurfer.average_hemispheres':
+        from cifti_to_freesurfer import average_hemispheres
+        maps = synthetic_maps(mesh, n_maps, seed)
+        def func():
+            results = []
+            for field, left, right in maps:
+                averaged_left = left.copy()
+                averaged_right = right.copy()
+                average_hemispheres(left, right, averaged_left, averaged_right)
+                results.append((averaged_left, averaged_right))
+            return results
+        return func, n_maps, map_fields(n_maps)
+    raise ValueError('Unknown stage %s' % stage)
+
+
+def script_stage(stage, mesh, n_maps, seed, run_dir, args):
+
+    # Writes the synthetic inputs into run_dir and returns the script calls,
+    # the folders holding their outputs and the number of maps processed
+    def folder(name):
+        path = os.path.join(run_dir, name)
+        os.makedirs(path)
+        return path
+
+    if stage == 'make_fsaverage':
+        maps_dir = os.path.join(run_dir, 'maps')
+        write_cifti_maps(maps_dir, mesh, n_maps, seed)
+        native, pseudo = folder('native'), folder('pseudo')
+        calls = [('make_fsaverage.py', [maps_dir, args.hcp_subject, 'FS', native, pseudo, SUBJECT])]
+        return calls, [native, pseudo], n_maps
+    if stage == 'cifti_to_freesurfer':
+        maps_dir = os.path.join(run_dir, 'maps')
+        write_cifti_maps(maps_dir, mesh, n_maps, seed)
+        native, pseudo = folder('native'), folder('pseudo')
+        calls = [('cifti_to_freesurfer.py', [maps_dir, args.workbench, args.freesurfer, standard_mesh_atlases_folder,
+                                             args.fs_subject, os.path.join(run_dir, 'workdir'), native, pseudo])]
+        return calls, [native, pseudo], n_maps
+    if stage == 'interpolate_cifti':
+        # Always the full set of inferred maps, whatever the map count
+        inferred_dir = os.path.join(run_dir, 'inferred')
+        write_inferred_maps(inferred_dir, args.hcp_subject, seed)
+        output = folder('output')
+        calls = [(os.path.join('utilities', 'interpolate_cifti.py'), [SUBJECT, inferred_dir, args.hcp_subject, output])]
+        return calls, [output], 2 * len(INFERRED_MAPS)
+    if stage == 'plot_maps':
+        size = int(mesh[len('volume'):])
+        template_path, map_paths = write_volumes(os.path.join(run_dir, 'volumes'), size, n_maps, seed)
+        output = folder('output')
+        calls = [('plot_maps.py', [template_path, map_path, '0.1', os.path.basename(map_path)[:-11] + '_statMap', output])
+                 for map_path in map_paths]
+        return calls, [output], n_maps
+    if stage == 'plot_cifti_maps':
+        map_paths = write_cifti_maps(os.path.join(run_dir, 'maps'), mesh, n_maps, seed)
+        temporary, output = folder('temporary'), folder('output')
+        calls = [('plot_cifti_maps.py', [map_path, SUBJECT, temporary, args.workbench, 'hot', output])
+                 for map_path in map_paths]
+        return calls, [output], n_maps
+    raise ValueError('Unknown stage %s' % stage)
+
+
+def missing_requirement(stage, args):
+
+    # Reason a stage cannot run here, or None
+    if stage in ('make_fsaverage', 'interpolate_cifti'):
+        try:
+            import neuropythy
+        except ImportError:
+            return 'neuropythy is not installed'
+    if stage in ('make_fsaverage', 'interpolate_cifti') and not args.hcp_subject:
+        return 'no --hcp-subject given'
+    if stage in ('cifti_to_freesurfer', 'plot_cifti_maps') and not args.workbench:
+        return 'no --workbench given'
+    if stage == 'cifti_to_freesurfer' and not (args.freesurfer and args.fs_subject):
+        return 'no --freesurfer and --fs-subject given'
+    if stage == 'plot_cifti_maps':
+        try:
+            import hcp_utils
+            import nilearn
+        except ImportError:
+            return 'hcp_utils and nilearn are not installed'
+    if stage == 'plot_maps':
+        try:
+            import imageio
+            import matplotlib
+        except ImportError:
+            return 'imageio and matplotlib are not installed'
+    return None
+
+
+def stage_meshes(stage, args):
+
+    # The conversion scripts only handle the 32k fs_LR mesh (hcp_utils also
+    # only ships the 32k surfaces), plot_maps is swept over volume sizes
+    if stage == 'plot_maps':
+        return ['volume%d' % size for size in args.volume_sizes]
+    if stage in SCRIPT_STAGES:
+        return ['32k_fs_LR']
+    return args.meshes
+
+
+def stage_map_counts(stage, args):
+
+    if stage in ('make_fsaverage.cartesian_to_polar', 'interpolate_cifti'):
+        return args.map_counts[:1]
+    return args.map_counts
+
+
+def golden_map_count(stage, args):
+
+    # Stages that always process the same set are checked at their only count
+    if stage in ('make_fsaverage.cartesian_to_polar', 'interpolate_cifti'):
+        return args.map_counts[0]
+    return GOLDEN_MAP_COUNT
+
+
+################################ Baseline comparison #####################################
+
+def result_key(stage, mesh, n_maps):
+    return '%s|%s|%d' % (stage, mesh, n_maps)
+
+
+def compare_golden(key, arrays, golden, rtol=1e-5, atol=1e-6):
+
+    # Outputs that no longer match the golden ones, including golden outputs
+    # that were not produced and outputs that have no golden counterpart. A
+    # stage and mesh without any golden outputs yet is not checked.
+    if not has_golden(key, golden):
+        return []
+    expected_keys = set(name for name in golden if name.startswith(key + '|'))
+    mismatches = []
+    for name, value in sorted(arrays.items()):
+        golden_key = '%s|%s' % (key, name)
+        if golden_key not in expected_keys:
+            mismatches.append('%s (unexpected output)' % golden_key)
+            continue
+        expected = golden[golden_key]
+        value = np.asarray(value, dtype=np.float64)
+        if expected.shape != value.shape or not np.allclose(value, expected, rtol=rtol, atol=atol, equal_nan=True):
+            mismatches.append(golden_key)
+    produced_keys = set('%s|%s' % (key, name) for name in arrays)
+    for golden_key in sorted(expected_keys - produced_keys):
+        mismatches.append('%s (missing output)' % golden_key)
+    return mismatches
+
+
+def has_golden(key, golden):
+    return any(name.startswith(key + '|') for name in golden)
+
+
+def compare_baseline(results, baseline, tolerance):
+
+    # Results that are slower or use more memory than the baseline by more
+    # than the tolerance. Memory differences under 1 MB are ignored.
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        before = baseline[key]
+        if result['seconds'] > before['seconds'] * (1 + tolerance):
+            regressions.append('%s: %.3fs -> %.3fs' % (key, before['seconds'], result['seconds']))
+        if result['peak_memory_mb'] > before['peak_memory_mb'] * (1 + tolerance) + 1:
+            regressions.append('%s: %.1fMB -> %.1fMB' % (key, before['peak_memory_mb'], result['peak_memory_mb']))
+    return regressions
+
+
+def update_baseline(baseline, report):
+
+    # Results of stages that were not run this time are kept
+    baseline = dict(baseline, meta=report['meta'])
+    baseline['results'] = dict(baseline.get('results', {}), **report['results'])
+    return baseline
+
+
+def update_golden(golden, new_golden):
+
+    # Replace, not merge, the golden outputs of every stage and mesh that was
+    # checked, so that removed or renamed outputs are dropped
+    checked = set(name.rsplit('|', 1)[0] for name in new_golden)
+    golden = dict((name, value) for name, value in golden.items() if name.rsplit('|', 1)[0] not in checked)
+    golden.update(new_golden)
+    return golden
+
+
+###################################### Main ##############################################
+
+def comma_list(convert=str):
+    return lambda value: [convert(item) for item in value.split(',') if item]
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--stages', type=comma_list(), default=KERNEL_STAGES + SCRIPT_STAGES,
+                        help='Comma separated stages. A script name also selects its in-process stages')
+    parser.add_argument('--meshes', type=comma_list(), default=list(MESHES), help='Meshes for the in-process stages')
+    parser.add_argument('--map-counts', type=comma_list(int), default=[1, 4, 16],
+                        help='Map counts to time. %d is always added for the golden check' % GOLDEN_MAP_COUNT)
+    parser.add_argument('--volume-sizes', type=comma_list(int), default=[24, 48], help='Volume edge lengths for plot_maps')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the timed map sets. The golden set always uses %d' % GOLDEN_SEED)
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'fmw_benchmark'))
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='Timings of an earlier run on this machine')
+    parser.add_argument('--golden', default=os.path.join(code_dir, 'benchmark_golden.npz'), help='Golden outputs')
+    parser.add_argument('--update-baseline', action='store_true', help='Save this run as the baseline and golden outputs')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed fractional slowdown or memory growth')
+    parser.add_argument('--python', default=sys.executable, help='Interpreter used to run the scripts')
+    parser.add_argument('--hcp-subject', help='HCP structural folder for make_fsaverage and interpolate_cifti')
+    parser.add_argument('--workbench', help='Path to wb_command')
+    parser.add_argument('--freesurfer', help='FreeSurfer installation with subjects/fsaverage')
+    parser.add_argument('--fs-subject', help='Subject in the FreeSurfer subjects folder for cifti_to_freesurfer')
+    args = parser.parse_args(argv)
+    args.map_counts = sorted(set(args.map_counts) | set([GOLDEN_MAP_COUNT]))
+    for stage in args.stages:
+        if stage not in KERNEL_STAGES + SCRIPT_STAGES:
+            parser.error('Unknown stage %s, choose from %s' % (stage, ', '.join(KERNEL_STAGES + SCRIPT_STAGES)))
+    for mesh in args.meshes:
+        if mesh not in MESHES:
+            parser.error('Unknown mesh %s, choose from %s' % (mesh, ', '.join(MESHES)))
+    return args
+
+
+def benchmark_postprocessing(argv):
+
+    args = parse_args(argv)
+    stages = [stage for stage in KERNEL_STAGES + SCRIPT_STAGES
+              if stage in args.stages or stage.split('.')[0] in args.stages]
+    golden = dict(np.load(args.golden)) if os.path.exists(args.golden) else {}
+    if os.path.exists(args.workdir):
+        shutil.rmtree(args.workdir)
+    os.makedirs(args.workdir)
+    log_path = os.path.join(args.workdir, 'scripts.log')
+
+    results = {}
+    new_golden = {}
+    mismatches = []
+    unchecked = []
+    failures = []
+    for stage in stages:
+        reason = missing_requirement(stage, args)
+        if reason:
+            print('Skipping %s: %s' % (stage, reason))
+            continue
+        for mesh in stage_meshes(stage, args):
+            for n_maps in stage_map_counts(stage, args):
+                print('Running %s on %s with %d maps' % (stage, mesh, n_maps))
+                checked = n_maps == golden_map_count(stage, args)
+                seed = GOLDEN_SEED if checked else args.seed
+                if stage in KERNEL_STAGES:
+                    func, n_processed, labels = kernel_stage(stage, mesh, n_maps, seed)
+                    elements = len(load_sphere(mesh)[0])
+                    seconds, peak_memory_mb, outputs = measure_in_process(func, args.repeats)
+                    arrays = {}
+                    for label, output in zip(labels, outputs):
+                        for i, value in enumerate(output):
+                            arrays['%s:%d' % (label, i)] = np.asarray(value, dtype=np.float64)
+                else:
+                    seconds, peak_memory_mb = float('inf'), 0.
+                    try:
+                        for repeat in range(args.repeats):
+                            run_dir = os.path.join(args.workdir, stage, mesh, '%d' % n_maps)
+                            if os.path.exists(run_dir):
+                                shutil.rmtree(run_dir)
+                            os.makedirs(run_dir)
+                            calls, output_folders, n_processed = script_stage(stage, mesh, n_maps, seed, run_dir, args)
+                            total = 0.
+                            for script, script_args in calls:
+                                (call_seconds, call_memory_mb) = run_script(args.python, script, script_args, log_path)
+                                total += call_seconds
+                                peak_memory_mb = max(peak_memory_mb, call_memory_mb)
+                            seconds = min(seconds, total)
+                    except RuntimeError as error:
+                        print('    FAILED %s' % error)
+                        failures.append(result_key(stage, mesh, n_maps))
+                        continue
+                    elements = len(load_sphere(mesh)[0]) if mesh in MESHES else int(mesh[len('volume'):]) ** 3
+                    arrays = summarize_outputs(output_folders)
+                key = result_key(stage, mesh, n_maps)
+                results[key] = {'stage': stage, 'mesh': mesh, 'n_maps': n_processed, 'elements': elements,
+                                'seconds': seconds, 'maps_per_second': n_processed / seconds,
+                                'peak_memory_mb': peak_memory_mb}
+                print('    %.3fs, %.1f maps/s, %.1fMB peak' % (seconds, n_processed / seconds, peak_memory_mb))
+                if checked:
+                    golden_key = '%s|%s' % (stage, mesh)
+                    if has_golden(golden_key, golden):
+                        mismatches += compare_golden(golden_key, arrays, golden)
+                    else:
+                        print('    not checked: no golden outputs for %s' % golden_key)
+                        unchecked.append(golden_key)
+                    for name, value in arrays.items():
+                        new_golden['%s|%s' % (golden_key, name)] = np.asarray(value)
+
+    report = {'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'nibabel': nb.__version__,
+                       'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                       'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'seed': args.seed, 'golden_seed': GOLDEN_SEED,
+                       'repeats': args.repeats},
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print('Results written to %s' % args.output)
+
+    if args.update_baseline:
+        # A baseline missing the failed stages would hide them from later runs
+        if failures:
+            for failure in failures:
+                print('FAILED %s' % failure)
+            print('Not updating the baseline because some stages failed')
+            return 1
+        baseline = {'results': {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        with open(args.baseline, 'w') as f:
+            json.dump(update_baseline(baseline, report), f, indent=1, sort_keys=True)
+        np.savez_compressed(args.golden, **update_golden(golden, new_golden))
+        print('Baseline written to %s, golden outputs to %s' % (args.baseline, args.golden))
+        return 0
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_baseline(results, json.load(f)['results'], args.tolerance)
+    else:
+        print('No baseline at %s, run with --update-baseline to create one' % args.baseline)
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    for mismatch in mismatches:
+        print('GOLDEN MISMATCH %s' % mismatch)
+    for key in unchecked:
+        print('NOT CHECKED %s: no golden outputs' % key)
+    for failure in failures:
+        print('FAILED %s' % failure)
+    return 1 if regressions or mismatches or failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(benchmark_postprocessing(sys.argv[1:]))
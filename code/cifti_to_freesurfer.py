@@ -1,7 +1,16 @@
-import os, sys
+import os, sys, shutil
 import nibabel as nb
+from incremental import Manifest, atomic_output, as_bool, code_hash, run_command, remove_files
 
-def cifti_to_freesurfer(path_to_cifti_maps, path_to_workbench, path_to_freesurfer, standard_mesh_atlases_folder, subject_id, workdir, native_mgz, native_mgz_pseudo_hemi):
+def average_hemispheres(cifti_left_data, cifti_right_data, averaged_hemi_left_data, averaged_hemi_right_data):
+
+    # Write the vertex-wise left/right average into both template arrays
+    for val in range(len(cifti_left_data)):
+        average_val = (cifti_left_data[val] + cifti_right_data[val])/2
+        averaged_hemi_left_data[val] = average_val
+        averaged_hemi_right_data[val] = average_val
+
+def cifti_to_freesurfer(path_to_cifti_maps, path_to_workbench, path_to_freesurfer, standard_mesh_atlases_folder, subject_id, workdir, native_mgz, native_mgz_pseudo_hemi, incremental=False):
     
     '''
     This script maps cifti images to freesurfer native and fsaverage surfaces
@@ -16,6 +25,9 @@ def cifti_to_freesurfer(path_to_cifti_maps, path_to_workbench, path_to_freesurfe
         workdir = Workdir where the intermediate outputs will be saved 
         native_mgz = Folder where the native mgz results will be saved
         native_mgz_pseudo_hemi = Folder where the pseudo hemi mgz results will be saved
+        incremental = '1' to reuse mgz files the manifest in native_mgz shows were
+                      made from the same cifti, atlases and sphere.reg surfaces.
+                      mainWrapper passes incrementalPostProcess here. Default off
     ''' 
 
     # Get freesurfer subjects dir and bin
@@ -30,6 +42,31 @@ def cifti_to_freesurfer(path_to_cifti_maps, path_to_workbench, path_to_freesurfe
     if not os.path.exists(native_mgz_pseudo_hemi):
         os.system('mkdir %s' % native_mgz_pseudo_hemi)
 
+    #  Set paths for the files we use for fsaverage mapping
+    current_sphere_left = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fs_LR-deformed_to-fsaverage.L.sphere.32k_fs_LR.surf.gii')
+    new_sphere_left = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fsaverage_std_sphere.L.164k_fsavg_L.surf.gii')
+    current_area_left = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fs_LR.L.midthickness_va_avg.32k_fs_LR.shape.gii')
+    new_area_left = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fsaverage.L.midthickness_va_avg.164k_fsavg_L.shape.gii')
+    
+    current_sphere_right = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fs_LR-deformed_to-fsaverage.R.sphere.32k_fs_LR.surf.gii')
+    new_sphere_right = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fsaverage_std_sphere.R.164k_fsavg_R.surf.gii')
+    current_area_right = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fs_LR.R.midthickness_va_avg.32k_fs_LR.shape.gii')
+    new_area_right = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fsaverage.R.midthickness_va_avg.164k_fsavg_R.shape.gii')
+
+    # Everything besides the map itself that shapes the outputs. The tools and
+    # surfaces are hashed along with the map so that a different Workbench or
+    # FreeSurfer build, or a different subject at the same path, is redone.
+    manifest = Manifest(native_mgz, enabled=as_bool(incremental))
+    params = {'code': code_hash(__file__), 'subject_id': subject_id}
+    shared_inputs = [shutil.which(path_to_workbench) or path_to_workbench,
+                     os.path.join(path_to_freesurfer_bin, 'mri_convert'), os.path.join(path_to_freesurfer_bin, 'mri_surf2surf'),
+                     current_sphere_left, new_sphere_left, current_area_left, new_area_left,
+                     current_sphere_right, new_sphere_right, current_area_right, new_area_right]
+    for subject in ['fsaverage', subject_id]:
+        for hemi in ['lh', 'rh']:
+            shared_inputs.append(os.path.join(path_to_subject_freesurfer, subject, 'surf', '%s.sphere.reg' % hemi))
+    shared_inputs = [path for path in shared_inputs if os.path.isfile(path)]
+
     for amap in os.listdir(path_to_cifti_maps):
         
         # Get file location
@@ -38,12 +75,40 @@ def cifti_to_freesurfer(path_to_cifti_maps, path_to_workbench, path_to_freesurfe
         # Get image name
         amap_name = os.path.split(amap)[1][:-13]
         
+        # Final outputs of this map
+        native_metric_left = os.path.join(native_mgz, 'L_%s.mgz' % amap_name)
+        native_metric_right = os.path.join(native_mgz, 'R_%s.mgz' % amap_name)
+        native_metric_left_pseudo = os.path.join(native_mgz_pseudo_hemi, 'L_%s.mgz' % amap_name)
+        native_metric_right_pseudo = os.path.join(native_mgz_pseudo_hemi, 'R_%s.mgz' % amap_name)
+        outputs = [native_metric_left, native_metric_right, native_metric_left_pseudo, native_metric_right_pseudo]
+        inputs = [initial_file_location] + shared_inputs
+        if manifest.up_to_date(outputs, inputs, params):
+            print('Up to date %s' % amap)
+            continue
+        
         # Set new paths for cifti hemispheres in gifti format
         cifti_left = os.path.join(workdir, 'cifti_left.func.gii')
         cifti_right = os.path.join(workdir, 'cifti_right.func.gii')
+        averaged_hemi_left_file = os.path.join(workdir, 'averaged_hemi_left.func.gii')
+        averaged_hemi_right_file = os.path.join(workdir, 'averaged_hemi_right.func.gii')    
+        metric_out_left = os.path.join(workdir, '%s.L.32k_fsavg_L.func.gii' % amap_name)
+        metric_out_pseudo_left = os.path.join(workdir, '%s.L.32k_fsavg_pseudo_L.func.gii' % amap_name)
+        metric_out_right = os.path.join(workdir, '%s.R.32k_fsavg_R.func.gii' % amap_name)
+        metric_out_pseudo_right = os.path.join(workdir, '%s.R.32k_fsavg_pseudo_R.func.gii' % amap_name)
+        fsaverage_files_in_workdir = os.path.join(workdir, 'fsaverage')
+        metric_out_left_mgz = os.path.join(fsaverage_files_in_workdir, 'L_%s.mgz' % amap_name)
+        metric_out_right_mgz = os.path.join(fsaverage_files_in_workdir, 'R_%s.mgz' % amap_name)
+        metric_out_pseudo_left_mgz = os.path.join(fsaverage_files_in_workdir, 'L_pseudo_%s.mgz' % amap_name)
+        metric_out_pseudo_right_mgz = os.path.join(fsaverage_files_in_workdir, 'R_pseudo_%s.mgz' % amap_name)       
+        
+        # Remove intermediates of the previous map or run so that a failed
+        # step can never pass their data on as this map's
+        remove_files(cifti_left, cifti_right, averaged_hemi_left_file, averaged_hemi_right_file,
+                     metric_out_left, metric_out_right, metric_out_pseudo_left, metric_out_pseudo_right,
+                     metric_out_left_mgz, metric_out_right_mgz, metric_out_pseudo_left_mgz, metric_out_pseudo_right_mgz)
         
         # Separate cifti files 
-        os.system('%s -cifti-separate %s COLUMN -metric CORTEX_LEFT %s -metric CORTEX_RIGHT %s' % (path_to_workbench,
+        run_command('%s -cifti-separate %s COLUMN -metric CORTEX_LEFT %s -metric CORTEX_RIGHT %s' % (path_to_workbench,
                                                                                                    initial_file_location, os.path.join(workdir, cifti_left),
                                                                                                    os.path.join(workdir, cifti_right)))
         
@@ -56,32 +121,11 @@ def cifti_to_freesurfer(path_to_cifti_maps, path_to_workbench, path_to_freesurfe
         averaged_hemi_right = nb.load(cifti_right) # We load the right hemi again to use as a averaged map template       
         averaged_hemi_left_data = averaged_hemi_left.darrays[0].data          
         averaged_hemi_right_data = averaged_hemi_right.darrays[0].data    
-       
-        averaged_hemi_left_file = os.path.join(workdir, 'averaged_hemi_left.func.gii')
-        averaged_hemi_right_file = os.path.join(workdir, 'averaged_hemi_right.func.gii')    
         
-        for val in range(len(cifti_left_data)):
-            average_val = (cifti_left_data[val] + cifti_right_data[val])/2
-            averaged_hemi_left_data[val] = average_val
-            averaged_hemi_right_data[val] = average_val
+        average_hemispheres(cifti_left_data, cifti_right_data, averaged_hemi_left_data, averaged_hemi_right_data)
         nb.save(averaged_hemi_left, averaged_hemi_left_file)    
         nb.save(averaged_hemi_right, averaged_hemi_right_file)  
         
-        #  Set paths for the files we use for fsaverage mapping
-        current_sphere_left = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fs_LR-deformed_to-fsaverage.L.sphere.32k_fs_LR.surf.gii')
-        new_sphere_left = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fsaverage_std_sphere.L.164k_fsavg_L.surf.gii')
-        metric_out_left = os.path.join(workdir, '%s.L.32k_fsavg_L.func.gii' % amap_name)
-        metric_out_pseudo_left = os.path.join(workdir, '%s.L.32k_fsavg_pseudo_L.func.gii' % amap_name)
-        current_area_left = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fs_LR.L.midthickness_va_avg.32k_fs_LR.shape.gii')
-        new_area_left = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fsaverage.L.midthickness_va_avg.164k_fsavg_L.shape.gii')
-        
-        current_sphere_right = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fs_LR-deformed_to-fsaverage.R.sphere.32k_fs_LR.surf.gii')
-        new_sphere_right = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fsaverage_std_sphere.R.164k_fsavg_R.surf.gii')
-        metric_out_right = os.path.join(workdir, '%s.R.32k_fsavg_R.func.gii' % amap_name)
-        metric_out_pseudo_right = os.path.join(workdir, '%s.R.32k_fsavg_pseudo_R.func.gii' % amap_name)
-        current_area_right = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fs_LR.R.midthickness_va_avg.32k_fs_LR.shape.gii')
-        new_area_right = os.path.join(standard_mesh_atlases_folder, 'resample_fsaverage', 'fsaverage.R.midthickness_va_avg.164k_fsavg_R.shape.gii')
-        
         # Run fsaverage conversion 
         left_hemi_run = '%s -metric-resample %s %s %s ADAP_BARY_AREA %s -area-metrics %s %s' % (path_to_workbench,
                                                                                                 cifti_left, current_sphere_left, new_sphere_left,
@@ -100,37 +144,35 @@ def cifti_to_freesurfer(path_to_cifti_maps, path_to_workbench, path_to_freesurfe
                                                                                                         metric_out_pseudo_right, current_area_right,
                                                                                                         new_area_right)    
         
-        os.system(left_hemi_run)
-        os.system(right_hemi_run)
-        os.system(left_hemi_pseudo_run)
-        os.system(right_hemi_pseudo_run)  
+        run_command(left_hemi_run)
+        run_command(right_hemi_run)
+        run_command(left_hemi_pseudo_run)
+        run_command(right_hemi_pseudo_run)  
         
         # Convert fsaverage gifti to mgz
-        fsaverage_files_in_workdir = os.path.join(workdir, 'fsaverage')
-        os.system('mkdir %s' % fsaverage_files_in_workdir)
-        metric_out_left_mgz = os.path.join(fsaverage_files_in_workdir, 'L_%s.mgz' % amap_name)
-        metric_out_right_mgz = os.path.join(fsaverage_files_in_workdir, 'R_%s.mgz' % amap_name)
-        metric_out_pseudo_left_mgz = os.path.join(fsaverage_files_in_workdir, 'L_pseudo_%s.mgz' % amap_name)
-        metric_out_pseudo_right_mgz = os.path.join(fsaverage_files_in_workdir, 'R_pseudo_%s.mgz' % amap_name)       
+        if not os.path.exists(fsaverage_files_in_workdir):
+            os.system('mkdir %s' % fsaverage_files_in_workdir)
         
         os.environ['FREESURFER_HOME'] = path_to_freesurfer
         os.environ['SUBJECTS_DIR'] = path_to_subject_freesurfer
-        os.system('%s %s %s' % (os.path.join(path_to_freesurfer_bin, 'mri_convert'), metric_out_left, metric_out_left_mgz))
-        os.system('%s %s %s' % (os.path.join(path_to_freesurfer_bin, 'mri_convert'), metric_out_right, metric_out_right_mgz))
-        os.system('%s %s %s' % (os.path.join(path_to_freesurfer_bin, 'mri_convert'), metric_out_pseudo_left, metric_out_pseudo_left_mgz))
-        os.system('%s %s %s' % (os.path.join(path_to_freesurfer_bin, 'mri_convert'), metric_out_pseudo_right, metric_out_pseudo_right_mgz))
+        run_command('%s %s %s' % (os.path.join(path_to_freesurfer_bin, 'mri_convert'), metric_out_left, metric_out_left_mgz))
+        run_command('%s %s %s' % (os.path.join(path_to_freesurfer_bin, 'mri_convert'), metric_out_right, metric_out_right_mgz))
+        run_command('%s %s %s' % (os.path.join(path_to_freesurfer_bin, 'mri_convert'), metric_out_pseudo_left, metric_out_pseudo_left_mgz))
+        run_command('%s %s %s' % (os.path.join(path_to_freesurfer_bin, 'mri_convert'), metric_out_pseudo_right, metric_out_pseudo_right_mgz))
         
         # Map fsaverage to fsnative
-        native_metric_left = os.path.join(native_mgz, 'L_%s.mgz' % amap_name)
-        native_metric_right = os.path.join(native_mgz, 'R_%s.mgz' % amap_name)
-        native_metric_left_pseudo = os.path.join(native_mgz_pseudo_hemi, 'L_%s.mgz' % amap_name)
-        native_metric_right_pseudo = os.path.join(native_mgz_pseudo_hemi, 'R_%s.mgz' % amap_name)
-        os.system('%s --srcsubject fsaverage --trgsubject %s --hemi lh --sval %s --tval %s' % (os.path.join(path_to_freesurfer_bin, 'mri_surf2surf'),
-                                                                                                subject_id, metric_out_left_mgz, native_metric_left))
-        os.system('%s --srcsubject fsaverage --trgsubject %s --hemi rh --sval %s --tval %s' % (os.path.join(path_to_freesurfer_bin, 'mri_surf2surf'),
-                                                                                                subject_id, metric_out_right_mgz, native_metric_right))  
-        os.system('%s --srcsubject fsaverage --trgsubject %s --hemi lh --sval %s --tval %s' % (os.path.join(path_to_freesurfer_bin, 'mri_surf2surf'),
-                                                                                                subject_id, metric_out_pseudo_left_mgz, native_metric_left_pseudo))
-        os.system('%s --srcsubject fsaverage --trgsubject %s --hemi rh --sval %s --tval %s' % (os.path.join(path_to_freesurfer_bin, 'mri_surf2surf'),
-                                                                                                subject_id, metric_out_pseudo_right_mgz, native_metric_right_pseudo)) 
-cifti_to_freesurfer(*sys.argv[1:])  
+        with atomic_output(native_metric_left) as tmp_path:
+            run_command('%s --srcsubject fsaverage --trgsubject %s --hemi lh --sval %s --tval %s' % (os.path.join(path_to_freesurfer_bin, 'mri_surf2surf'),
+                                                                                                    subject_id, metric_out_left_mgz, tmp_path))
+        with atomic_output(native_metric_right) as tmp_path:
+            run_command('%s --srcsubject fsaverage --trgsubject %s --hemi rh --sval %s --tval %s' % (os.path.join(path_to_freesurfer_bin, 'mri_surf2surf'),
+                                                                                                    subject_id, metric_out_right_mgz, tmp_path))  
+        with atomic_output(native_metric_left_pseudo) as tmp_path:
+            run_command('%s --srcsubject fsaverage --trgsubject %s --hemi lh --sval %s --tval %s' % (os.path.join(path_to_freesurfer_bin, 'mri_surf2surf'),
+                                                                                                    subject_id, metric_out_pseudo_left_mgz, tmp_path))
+        with atomic_output(native_metric_right_pseudo) as tmp_path:
+            run_command('%s --srcsubject fsaverage --trgsubject %s --hemi rh --sval %s --tval %s' % (os.path.join(path_to_freesurfer_bin, 'mri_surf2surf'),
+                                                                                                    subject_id, metric_out_pseudo_right_mgz, tmp_path)) 
+        manifest.record(outputs, inputs, params)
+if __name__ == '__main__':
+    cifti_to_freesurfer(*sys.argv[1:])  
@@ -0,0 +1,203 @@
+'''
+Helpers that let the map conversion and plotting scripts skip work whose
+outputs are already up to date, and write their outputs atomically.
+
+A Manifest is a json file that sits in an output folder. For every output
+file it records the content hashes of the inputs that produced it, the
+parameters it was made with, and the hash of the output itself. An output is
+up to date when all of those still match. Outputs are written to a temporary
+file in the destination folder and renamed into place only once complete, so
+an interrupted run never leaves a partial MGZ/GIF behind under the final name.
+
+Callers put everything that shapes an output into its inputs and parameters:
+the input maps, the subject surfaces and external tools used to make it (as
+inputs, so their contents are hashed), and code_hash() of the calling script.
+'''
+
+import os
+import re
+import json
+import hashlib
+import contextlib
+
+MANIFEST_NAME = '.incremental_manifest.json'
+
+
+def as_bool(value):
+
+    # Arguments arrive from the command line as strings
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def file_hash(path, block_size=1 << 20):
+
+    # sha256 of the file contents, read in blocks to keep memory flat
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_hash(*paths):
+
+    # Combined hash of the given scripts and of this module, so that a change
+    # to the code that makes an output invalidates it
+    digest = hashlib.sha256()
+    for path in list(paths) + [__file__]:
+        digest.update(file_hash(os.path.abspath(path)).encode())
+    return digest.hexdigest()
+
+
+def run_command(command):
+
+    # os.system that raises on a nonzero exit status. Used for every external
+    # tool that produces an output, so that a tool that failed part way
+    # through is never mistaken for finished work.
+    status = os.system(command)
+    if status != 0:
+        raise RuntimeError('Command exited with status %d: %s' % (status, command))
+
+
+def remove_files(*paths):
+
+    # Remove intermediates left by an earlier map or run before remaking them
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _pid_running(pid):
+
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def remove_stale_temporaries(folder, name=None):
+
+    # Remove temporary files left in folder by runs that were killed. Files
+    # of processes that are still running are left alone.
+    if not os.path.isdir(folder):
+        return
+    pattern = re.compile(r'^\.tmp(\d+)_(.+)$')
+    for filename in os.listdir(folder):
+        match = pattern.match(filename)
+        if match is None or (name is not None and match.group(2) != name):
+            continue
+        if not _pid_running(int(match.group(1))):
+            os.remove(os.path.join(folder, filename))
+
+
+def temporary_path(path):
+
+    # Keep the temporary file in the destination folder so the final rename
+    # never crosses file systems, and keep the full file name as the suffix so
+    # that tools which pick the format from the extension still work.
+    folder, name = os.path.split(os.path.abspath(path))
+    return os.path.join(folder, '.tmp%d_%s' % (os.getpid(), name))
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+
+    '''
+    Yield a temporary path to write to in place of path. On success the
+    temporary file is renamed to path. If the block raises, or the file was
+    never written, path is left untouched and the temporary file discarded.
+    External commands run inside the block must go through run_command so
+    that a failure raises here rather than renaming a partial file.
+    '''
+
+    tmp_path = temporary_path(path)
+    remove_stale_temporaries(*os.path.split(os.path.abspath(path)))
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if not os.path.exists(tmp_path):
+        raise IOError('%s was not written' % path)
+    os.replace(tmp_path, path)
+
+
+class Manifest:
+
+    def __init__(self, folder, enabled=True):
+
+        # When disabled nothing is ever up to date and nothing is recorded,
+        # which reproduces the original regenerate-everything behaviour.
+        self.enabled = enabled
+        self.path = os.path.join(folder, MANIFEST_NAME)
+        self.entries = {}
+        self._hashes = {}
+        remove_stale_temporaries(folder)
+        if enabled and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print('Ignoring unreadable manifest %s' % self.path)
+
+    def _hash(self, path):
+
+        # Cache hashes for the lifetime of the run, invalidated if the file
+        # changes size or modification time underneath us
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime_ns)
+        cached = self._hashes.get(path)
+        if cached is None or cached[0] != key:
+            cached = (key, file_hash(path))
+            self._hashes[path] = cached
+        return cached[1]
+
+    def _entry(self, inputs, params):
+
+        # Round trip the parameters through json so that e.g. tuples and
+        # lists compare equal to what was loaded from disk
+        return {'inputs': {os.path.abspath(i): self._hash(os.path.abspath(i)) for i in inputs},
+                'params': json.loads(json.dumps(params))}
+
+    def up_to_date(self, outputs, inputs, params):
+
+        if not self.enabled:
+            return False
+        for i in inputs:
+            if not os.path.exists(i):
+                return False
+        entry = self._entry(inputs, params)
+        for output in outputs:
+            output = os.path.abspath(output)
+            recorded = self.entries.get(output)
+            if recorded is None or not os.path.exists(output):
+                return False
+            if recorded['inputs'] != entry['inputs'] or recorded['params'] != entry['params']:
+                return False
+            if recorded['output'] != self._hash(output):
+                return False
+        return True
+
+    def record(self, outputs, inputs, params):
+
+        if not self.enabled:
+            return
+        entry = self._entry(inputs, params)
+        for output in outputs:
+            output = os.path.abspath(output)
+            self.entries[output] = dict(entry, output=self._hash(output))
+        self.save()
+
+    def save(self):
+
+        with atomic_output(self.path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
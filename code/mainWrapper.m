@@ -112,6 +112,11 @@ function [structDirPath,subjectName,nativeSpaceDirPath,pseudoHemiDirPath] = main
 %                           pool is invoked so that the virtual cores
 %                           that are created in a GCP VM are available for
 %                           use by the par pool.
+%  'incrementalPostProcess' - String. Valid values of 1 or 0. If set to 1,
+%                           the external Python map conversion and plotting
+%                           routines skip outputs that a manifest in their
+%                           output folder records as already made from the
+%                           current inputs and parameters.
 %  'vxsPass'              - Numeric. A vector of values that define the
 %                           mask of voxels/vertices to be analyzed. This
 %                           option over-rides the mask input, and is used
@@ -217,6 +222,7 @@ p.addParameter('outPath', '', @isstr);
 
 % Control
 p.addParameter('flywheelFlag', '0', @isstr);
+p.addParameter('incrementalPostProcess', '0', @isstr);
 
 % Config options - demo over-ride
 p.addParameter('vxsPass', [], @isnumeric)
@@ -345,7 +351,7 @@ if strcmp(p.Results.dataFileType,'volumetric')
             for mm = 1:length(results.meta.mapField)
                 mapPath = fullfile(mapsPath,[p.Results.Subject '_' results.meta.mapField{mm} '_map.nii.gz']);
                 gifOutStemName = [p.Results.Subject '_' results.meta.mapField{mm} '_statMap'];
-                command =  ['python3.7 ' p.Results.externalMapGifMakerPath ' ' displayAnat ' ' mapPath ' ' threshold ' ' gifOutStemName ' ' p.Results.outPath];
+                command =  ['python3.7 ' p.Results.externalMapGifMakerPath ' ' displayAnat ' ' mapPath ' ' threshold ' ' gifOutStemName ' ' p.Results.outPath ' ' p.Results.incrementalPostProcess];
                 callErrorStatus = system(command);
                 if callErrorStatus
                     warning('An error occurred during execution of the external Python function for map conversion');
@@ -408,7 +414,7 @@ if strcmp(p.Results.dataFileType,'cifti')
             subjectName = fileList.name;    
             
             % Perform the call and report if an error occurred
-            command =  ['python3.7 ' p.Results.externalMGZMakerPath ' ' mapsPath ' ' structDirPath ' ' p.Results.RegName ' ' nativeSpaceDirPath ' ' pseudoHemiDirPath ' ' p.Results.Subject];
+            command =  ['python3.7 ' p.Results.externalMGZMakerPath ' ' mapsPath ' ' structDirPath ' ' p.Results.RegName ' ' nativeSpaceDirPath ' ' pseudoHemiDirPath ' ' p.Results.Subject ' ' p.Results.incrementalPostProcess];
             callErrorStatus = system(command);
             if callErrorStatus
                 warning('An error occurred during execution of the external Python function for map conversion');
@@ -441,7 +447,7 @@ if strcmp(p.Results.dataFileType,'cifti')
             end           
             
             % Perform the call and report if an error occurred
-            command =  ['python3.7 ' p.Results.externalCiftiToFreesurferPath ' ' mapsPath ' ' p.Results.workbenchPath ' ' p.Results.freesurferInstallationPath ' ' p.Results.standardMeshAtlasesFolder ' ' subjectName ' ' p.Results.workDir ' ' nativeSpaceDirPath ' ' pseudoHemiDirPath];
+            command =  ['python3.7 ' p.Results.externalCiftiToFreesurferPath ' ' mapsPath ' ' p.Results.workbenchPath ' ' p.Results.freesurferInstallationPath ' ' p.Results.standardMeshAtlasesFolder ' ' subjectName ' ' p.Results.workDir ' ' nativeSpaceDirPath ' ' pseudoHemiDirPath ' ' p.Results.incrementalPostProcess];
             fprintf(command)
             callErrorStatus = system(command);
             if callErrorStatus
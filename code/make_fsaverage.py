@@ -1,28 +1,112 @@
 import sys
-import neuropythy as ny
 import numpy as np
 import os 
+from incremental import Manifest, atomic_output, as_bool, code_hash
 
-def make_fsaverage(path_to_cifti_maps, path_to_hcp, alignment_type, native_mgz, native_mgz_pseudo_hemi, subject_id):
+def pseudo_hemi_average(orig_lhdat, orig_rhdat, negate=False):
 
-############# Load the FSLR_32k and native left and right hemispheres #####################
-    print('Starting')
+    # Average each hemisphere with the flipped other hemisphere. The cartX
+    # maps are negated before averaging since x changes sign across the
+    # vertical meridian.
+    
+    # Get a copy of the unprocessed hemispheres and overwrite them with the
+    # flipped versions. Getiing a copy to preserve the voxel information
+    flipped_rhdat = orig_rhdat.copy()
+    flipped_lhdat = orig_lhdat.copy()
+    for length in range(len(orig_lhdat)):
+        flipped_rhdat[length] = orig_lhdat[length]
+        flipped_lhdat[length] = orig_rhdat[length]
+    
+    # Get another copy of the unprocessed images and overwrite them with
+    # the flipped-unflipped averages
+    final_averaged_left = orig_lhdat.copy()
+    final_averaged_right = orig_rhdat.copy()
+    for length in range(len(orig_lhdat)):
+        if negate:
+            final_averaged_left[length] = (orig_lhdat[length] + (-1 * flipped_lhdat[length]))/2
+            final_averaged_right[length] = (orig_rhdat[length] + (-1 * flipped_rhdat[length]))/2
+        else:
+            final_averaged_left[length] = (orig_lhdat[length] + flipped_lhdat[length])/2
+            final_averaged_right[length] = (orig_rhdat[length] + flipped_rhdat[length])/2
     
-    sub = ny.hcp_subject(path_to_hcp, default_alignment=alignment_type)
-    hem_from_left = sub.hemis['lh_LR32k']
-    hem_from_right = sub.hemis['rh_LR32k']
-    hem_to_left = sub.hemis['lh']
-    hem_to_right = sub.hemis['rh']
+    return final_averaged_left, final_averaged_right
+
+def cartesian_to_polar(x, y):
+
+    # Calculate the angle and eccentricity
+    angle_new_template = np.rad2deg(np.mod(np.arctan2(y,x), 2*np.pi))
+    eccentricity_new_template = np.sqrt(x**2 + y**2)
+    
+###################### Wrap angle maps to -180 - 180 scale ################################
+    
+    # Rescale the angle maps
+    angle_converted = (np.abs(angle_new_template - 360) + 90) % 360
+    for i in range(len(angle_new_template)):
+        if angle_converted[i] < -180 or angle_converted[i] > 180:
+            angle_converted[i] = ((angle_converted[i] + 180) % 360) - 180
+    
+    return angle_converted, eccentricity_new_template
+
+def subject_sphere_files(path_to_hcp):
+
+    # The registered spheres neuropythy interpolates between. They are hashed
+    # as inputs so that a different subject unpacked at the same path is redone.
+    spheres = []
+    for root, dirs, files in os.walk(path_to_hcp):
+        spheres += [os.path.join(root, name) for name in files
+                    if 'sphere' in name and (name.endswith('.surf.gii') or name.endswith('.reg'))]
+    return sorted(spheres)
+
+def make_fsaverage(path_to_cifti_maps, path_to_hcp, alignment_type, native_mgz, native_mgz_pseudo_hemi, subject_id, incremental=False):
+
+    # With incremental '1' (mainWrapper's incrementalPostProcess, default '0')
+    # a map is skipped when the manifest in native_mgz shows its mgz files
+    # made from the same cifti and subject spheres.
+    # neuropythy is imported here so that the numeric helpers above can be
+    # used (and benchmarked) without it.
+    import neuropythy as ny
+    print('Starting')
+    manifest = Manifest(native_mgz, enabled=as_bool(incremental))
+    params = {'code': code_hash(__file__), 'neuropythy': getattr(ny, '__version__', ''),
+              'alignment_type': alignment_type, 'subject_id': subject_id}
+    subject_inputs = subject_sphere_files(path_to_hcp) if manifest.enabled else []
     
 ############# Set a dictionary for the AnalyzePRF results #################################
     
     maps = os.listdir(path_to_cifti_maps)
     
+    # When both cartesian maps are present the eccentricity and angle maps are
+    # rebuilt from them below, so interpolating the fitted ones is wasted work
+    cart_maps = ['%s_cartX_map.dtseries.nii' % subject_id, '%s_cartY_map.dtseries.nii' % subject_id]
+    if all(cart_map in maps for cart_map in cart_maps):
+        superseded = ['%s_eccen_map.dtseries.nii' % subject_id, '%s_angle_map.dtseries.nii' % subject_id]
+        maps = [amap for amap in maps if amap not in superseded]
+    
+    # Work out which maps need to be redone before paying for the subject load
+    pending = []
+    for amap in maps:
+        outputs = [os.path.join(native_mgz,'L_%s.mgz'%amap[:-13]), os.path.join(native_mgz,'R_%s.mgz'%amap[:-13]),
+                   os.path.join(native_mgz_pseudo_hemi,'L_%s.mgz'%amap[:-13]), os.path.join(native_mgz_pseudo_hemi,'R_%s.mgz'%amap[:-13])]
+        if manifest.up_to_date(outputs, [os.path.join(path_to_cifti_maps, amap)] + subject_inputs, params):
+            print('Up to date %s'%amap)
+        else:
+            pending.append((amap, outputs))
+    
 #### Interpolate AnalyzePRF maps over subject's native surface do the flip and average ####   
     
-    print('Starting: Left-Right averaging and interpolation')
+    if pending:
     
-    for amap in maps:
+############# Load the FSLR_32k and native left and right hemispheres #####################
+        
+        sub = ny.hcp_subject(path_to_hcp, default_alignment=alignment_type)
+        hem_from_left = sub.hemis['lh_LR32k']
+        hem_from_right = sub.hemis['rh_LR32k']
+        hem_to_left = sub.hemis['lh']
+        hem_to_right = sub.hemis['rh']
+        
+        print('Starting: Left-Right averaging and interpolation')
+    
+    for amap, outputs in pending:
         
         print('Processing %s'%amap)
        
@@ -32,34 +116,23 @@ def make_fsaverage(path_to_cifti_maps, path_to_hcp, alignment_type, native_mgz,
         (orig_lhdat, orig_rhdat, orig_other) = ny.hcp.cifti_split(tempim)  
         original_result_left = hem_from_left.interpolate(hem_to_left, orig_lhdat)
         original_result_right = hem_from_right.interpolate(hem_to_right, orig_rhdat)
-        ny.save(os.path.join(native_mgz,'L_%s.mgz'%amap[:-13]), original_result_left)
-        ny.save(os.path.join(native_mgz,'R_%s.mgz'%amap[:-13]), original_result_right)
-        
-        # Get a copy of the unprocessed hemispheres and overwrite them with the
-        # flipped versions. Getiing a copy to preserve the voxel information
-        flipped_rhdat = orig_rhdat.copy()
-        flipped_lhdat = orig_lhdat.copy()
-        for length in range(len(orig_lhdat)):
-            flipped_rhdat[length] = orig_lhdat[length]
-            flipped_lhdat[length] = orig_rhdat[length]
+        with atomic_output(outputs[0]) as tmp_path:
+            ny.save(tmp_path, original_result_left)
+        with atomic_output(outputs[1]) as tmp_path:
+            ny.save(tmp_path, original_result_right)
         
-        # Get another copy of the unprocessed images and overwrite them with
-        # the flipped-unflipped averages
-        final_averaged_left = orig_lhdat.copy()
-        final_averaged_right = orig_rhdat.copy()
-        for length in range(len(orig_lhdat)):
-            if amap == '%s_cartX_map.dtseries.nii' % (subject_id):
-                final_averaged_left[length] = (orig_lhdat[length] + (-1 * flipped_lhdat[length]))/2
-                final_averaged_right[length] = (orig_rhdat[length] + (-1 * flipped_rhdat[length]))/2
-            else:
-                final_averaged_left[length] = (orig_lhdat[length] + flipped_lhdat[length])/2
-                final_averaged_right[length] = (orig_rhdat[length] + flipped_rhdat[length])/2
+        # Average with the flipped hemispheres
+        (final_averaged_left, final_averaged_right) = pseudo_hemi_average(orig_lhdat, orig_rhdat,
+                                                                          negate=amap == '%s_cartX_map.dtseries.nii' % (subject_id))
          
         # Interpolate the processed images and save them
         averaged_result_left = hem_from_left.interpolate(hem_to_left, final_averaged_left)
         averaged_result_right = hem_from_right.interpolate(hem_to_right, final_averaged_right)
-        ny.save(os.path.join(native_mgz_pseudo_hemi,'L_%s.mgz'%amap[:-13]), averaged_result_left)
-        ny.save(os.path.join(native_mgz_pseudo_hemi,'R_%s.mgz'%amap[:-13]), averaged_result_right)
+        with atomic_output(outputs[2]) as tmp_path:
+            ny.save(tmp_path, averaged_result_left)
+        with atomic_output(outputs[3]) as tmp_path:
+            ny.save(tmp_path, averaged_result_right)
+        manifest.record(outputs, [os.path.join(path_to_cifti_maps, amap)] + subject_inputs, params)
     
 ##################### Convert cartesian x-y maps to polar maps ############################      
     test_name = 'L_%s_cartX_map.mgz' % subject_id
@@ -72,6 +145,14 @@ def make_fsaverage(path_to_cifti_maps, path_to_hcp, alignment_type, native_mgz,
                 variable = native_mgz
             elif i == 1: 
                 variable = native_mgz_pseudo_hemi
+            
+            cart_inputs = [os.path.join(variable, '%s_%s_%s_map.mgz' % (hemi, subject_id, cart))
+                           for hemi in ['L', 'R'] for cart in ['cartX', 'cartY']]
+            polar_outputs = [os.path.join(variable, '%s_%s_%s_map.mgz' % (hemi, subject_id, polar))
+                             for hemi in ['L', 'R'] for polar in ['eccen', 'angle']]
+            if manifest.up_to_date(polar_outputs, cart_inputs, params):
+                print('Up to date polar maps in %s' % variable)
+                continue
                 
             # Reload the X-Y cartesian images.
             left_x = ny.load(os.path.join(variable, 'L_%s_cartX_map.mgz' % subject_id))
@@ -79,33 +160,24 @@ def make_fsaverage(path_to_cifti_maps, path_to_hcp, alignment_type, native_mgz,
             right_x = ny.load(os.path.join(variable, 'R_%s_cartX_map.mgz' % subject_id))
             right_y = ny.load(os.path.join(variable, 'R_%s_cartY_map.mgz' % subject_id))
             
-            # Calculate the angle and eccentricity
-            left_angle_new_template = np.rad2deg(np.mod(np.arctan2(left_y,left_x), 2*np.pi))
-            left_eccentricity_new_template = np.sqrt(left_x**2 + left_y**2)
-            right_angle_new_template = np.rad2deg(np.mod(np.arctan2(right_y,right_x), 2*np.pi))
-            right_eccentricity_new_template = np.sqrt(right_x**2 + right_y**2)
+            # Calculate the angle, wrapped to -180 - 180, and eccentricity
+            (left_angle_converted, left_eccentricity_new_template) = cartesian_to_polar(left_x, left_y)
+            (right_angle_converted, right_eccentricity_new_template) = cartesian_to_polar(right_x, right_y)
             
             # Overwriting the eccentricity maps with the new ones.
-            ny.save(os.path.join(variable,'L_%s_eccen_map.mgz' % subject_id), left_eccentricity_new_template) 
-            ny.save(os.path.join(variable,'R_%s_eccen_map.mgz' % subject_id), right_eccentricity_new_template) 
-        
-###################### Wrap angle maps to -180 - 180 scale ################################
-            
-            # Rescale the angle maps
-            left_angle_converted = (np.abs(left_angle_new_template - 360) + 90) % 360
-            for i in range(len(left_angle_new_template)):
-                if left_angle_converted[i] < -180 or left_angle_converted[i] > 180:
-                    left_angle_converted[i] = ((left_angle_converted[i] + 180) % 360) - 180
-            
-            right_angle_converted = (np.abs(right_angle_new_template - 360) + 90) % 360
-            for i in range(len(right_angle_new_template)):
-                if right_angle_converted[i] < -180 or right_angle_converted[i] > 180:
-                    right_angle_converted[i] = ((right_angle_converted[i] + 180) % 360) - 180
+            with atomic_output(os.path.join(variable,'L_%s_eccen_map.mgz' % subject_id)) as tmp_path:
+                ny.save(tmp_path, left_eccentricity_new_template) 
+            with atomic_output(os.path.join(variable,'R_%s_eccen_map.mgz' % subject_id)) as tmp_path:
+                ny.save(tmp_path, right_eccentricity_new_template) 
             
             # Overwriting the angle maps with the new ones.
-            ny.save(os.path.join(variable,'L_%s_angle_map.mgz' % subject_id), left_angle_converted)
-            ny.save(os.path.join(variable,'R_%s_angle_map.mgz' % subject_id), right_angle_converted)
+            with atomic_output(os.path.join(variable,'L_%s_angle_map.mgz' % subject_id)) as tmp_path:
+                ny.save(tmp_path, left_angle_converted)
+            with atomic_output(os.path.join(variable,'R_%s_angle_map.mgz' % subject_id)) as tmp_path:
+                ny.save(tmp_path, right_angle_converted)
+            manifest.record(polar_outputs, cart_inputs, params)
 
     print('Done !')
 
-make_fsaverage(*sys.argv[1:])
+if __name__ == '__main__':
+    make_fsaverage(*sys.argv[1:])
@@ -1,11 +1,12 @@
-import os, sys, nilearn
+import os, sys, shutil, nilearn
 from nilearn import plotting
 import matplotlib.pyplot as plt
 import hcp_utils as hcp
 import nibabel as nb
 import numpy as np
+from incremental import Manifest, atomic_output, as_bool, code_hash, run_command, remove_files
 
-def plot_cifti_maps(cifti_R2_map_path, subject_id, temporary_file_folder, wb_command_path, colormap, output_folder):
+def plot_cifti_maps(cifti_R2_map_path, subject_id, temporary_file_folder, wb_command_path, colormap, output_folder, incremental=False):
     
     if os.path.split(cifti_R2_map_path)[1][-13:] == '.dtseries.nii' or os.path.split(cifti_R2_map_path)[1][-13:] == '.dscalar.nii':
         image_name = os.path.split(cifti_R2_map_path)[1][:-13]
@@ -13,6 +14,18 @@ def plot_cifti_maps(cifti_R2_map_path, subject_id, temporary_file_folder, wb_com
         RuntimeError('Cifti type is not recognized. Only can process dtseries and dscalar')
     image_name = str(image_name)
     
+    # Pass '1' (or true/yes/on) as the last argument to keep a diagnostics
+    # zip that the manifest shows was made from the same cifti and colormap.
+    # The default, as when the argument is left out, rebuilds it.
+    zip_path = os.path.join(output_folder, 'diagnostics_%s.html.zip' % image_name)
+    manifest = Manifest(output_folder, enabled=as_bool(incremental))
+    params = {'colormap': colormap, 'code': code_hash(__file__), 'nilearn': nilearn.__version__,
+              'hcp_utils': getattr(hcp, '__version__', '')}
+    inputs = [cifti_R2_map_path] + [path for path in [shutil.which(wb_command_path) or wb_command_path] if os.path.isfile(path)]
+    if manifest.up_to_date([zip_path], inputs, params):
+        print('Diagnostics for %s are up to date' % image_name)
+        return
+    
     print('Processing %s' % image_name)
 
     volume_path = os.path.join(temporary_file_folder, image_name + '.nii.gz')
@@ -25,8 +38,9 @@ def plot_cifti_maps(cifti_R2_map_path, subject_id, temporary_file_folder, wb_com
                                                                                                                           volume_path,
                                                                                                                           surf_left_path,
                                                                                                                           surf_right_path)
-    # Run the command
-    os.system(volume_sep_command)
+    # Run the command, making sure nothing of an earlier run can be picked up
+    remove_files(volume_path, surf_left_path, surf_right_path)
+    run_command(volume_sep_command)
 
     # Initialize figures
     fig1 = plt.figure(figsize=[11,6])
@@ -37,6 +51,8 @@ def plot_cifti_maps(cifti_R2_map_path, subject_id, temporary_file_folder, wb_com
     
     # Create a temporary html and image folder
     temporary_html_folder = os.path.join(temporary_file_folder, image_name)
+    if os.path.exists(temporary_html_folder):
+        shutil.rmtree(temporary_html_folder)
     if ~os.path.exists(temporary_html_folder):
         os.system('mkdir %s' % temporary_html_folder)    
     temporary_image_folder = os.path.join(temporary_html_folder, 'images')
@@ -108,8 +124,12 @@ def plot_cifti_maps(cifti_R2_map_path, subject_id, temporary_file_folder, wb_com
     html_file.write(html_content)
     html_file.close()
     
-    os.system('cd %s; zip -r -q %s *' % (temporary_html_folder, os.path.join(output_folder, 'diagnostics_%s.html.zip' % image_name)))
+    # Zipping to a fresh temporary file also stops zip from adding to a stale
+    # archive left by an earlier run
+    with atomic_output(zip_path) as tmp_path:
+        run_command('cd %s; zip -r -q %s *' % (temporary_html_folder, tmp_path))
     os.system('rm -r %s' % temporary_html_folder)
     os.system('rm %s %s %s' % (volume_path, surf_left_path, surf_right_path))
+    manifest.record([zip_path], inputs, params)
     
 plot_cifti_maps(*sys.argv[1:])
@@ -3,12 +3,28 @@ import nibabel as nb
 import matplotlib.pyplot as plt
 import numpy as np
 import imageio
+import matplotlib
 import re 
 import sys
+import shutil
 import warnings
+from incremental import Manifest, atomic_output, as_bool, code_hash, run_command, remove_files
 warnings.filterwarnings("ignore")
 
-def plot_maps(template_path, map_path, threshold, stem_name, output):
+def plot_maps(template_path, map_path, threshold, stem_name, output, incremental=False):
+    
+    # mainWrapper passes incrementalPostProcess ('1' or '0', off by default)
+    # as the last argument; with '1' the three gifs are kept when the manifest
+    # in output shows them made from the same template, map and threshold.
+    flirt_path = '/usr/lib/fsl/5.0/flirt'
+    gif_paths = ['/%s/%s_%s.gif' % (output, stem_name, plane) for plane in ['saggital_plots', 'axial_plots', 'coronal_plots']]
+    manifest = Manifest(output, enabled=as_bool(incremental))
+    params = {'threshold': float(threshold), 'code': code_hash(__file__),
+              'matplotlib': matplotlib.__version__, 'imageio': imageio.__version__}
+    inputs = [template_path, map_path] + [path for path in [flirt_path] if os.path.isfile(path)]
+    if manifest.up_to_date(gif_paths, inputs, params):
+        print('Gifs for %s are up to date' % stem_name)
+        return
     
     print('Generating gifs')
     threshold = float(threshold)	    
@@ -29,9 +45,12 @@ def plot_maps(template_path, map_path, threshold, stem_name, output):
         resampled_image_folder = '/tmp/resampled_image_folder'
         if not os.path.exists(resampled_image_folder):
             os.system('mkdir %s' % resampled_image_folder)
-        os.system('FSLDIR=/usr/lib/fsl/5.0;. /etc/fsl/5.0/fsl.sh;PATH=${FSLDIR}:${PATH};export FSLDIR PATH;/usr/lib/fsl/5.0/flirt -in %s -ref %s -out %s -applyxfm' % (map_path,
-                                                                                                                                                                       template_path,
-                                                                                                                                                                       os.path.join(resampled_image_folder, 'resampled_map.nii.gz')))
+        # Never fall back on the resample of a previous map
+        remove_files(os.path.join(resampled_image_folder, 'resampled_map.nii.gz'))
+        run_command('FSLDIR=/usr/lib/fsl/5.0;. /etc/fsl/5.0/fsl.sh;PATH=${FSLDIR}:${PATH};export FSLDIR PATH;%s -in %s -ref %s -out %s -applyxfm' % (flirt_path,
+                                                                                                                                                     map_path,
+                                                                                                                                                     template_path,
+                                                                                                                                                     os.path.join(resampled_image_folder, 'resampled_map.nii.gz')))
         map_load = nb.load(os.path.join(resampled_image_folder, 'resampled_map.nii.gz'))
      
     template_data = template_load.get_data()
@@ -39,8 +58,9 @@ def plot_maps(template_path, map_path, threshold, stem_name, output):
     map_data = np.ma.masked_where(map_data < threshold, map_data)
     
     saggital_temp = os.path.join(output, 'saggital_temp') 
-    if not os.path.exists(saggital_temp):
-        os.system('mkdir %s' % saggital_temp)
+    if os.path.exists(saggital_temp):
+        shutil.rmtree(saggital_temp)
+    os.system('mkdir %s' % saggital_temp)
     for i in range(map_data.shape[0]):
         if np.nanmax(template_data[i,:,:]) != 0:
             plt.imshow(template_data[i,:,:], cmap='gray', aspect=template_dimensions[0])
@@ -52,8 +72,9 @@ def plot_maps(template_path, map_path, threshold, stem_name, output):
             plt.close()
     
     axial_temp = os.path.join(output, 'axial_temp')
-    if not os.path.exists(axial_temp):
-        os.system('mkdir %s' % axial_temp)
+    if os.path.exists(axial_temp):
+        shutil.rmtree(axial_temp)
+    os.system('mkdir %s' % axial_temp)
     for i in range(map_data.shape[1]):
         if np.nanmax(template_data[:,i,:]) != 0:
             plt.imshow(template_data[:,i,:], cmap='gray', aspect=template_dimensions[1])
@@ -65,8 +86,9 @@ def plot_maps(template_path, map_path, threshold, stem_name, output):
             plt.close()    
         
     coronal_temp = os.path.join(output, 'coronal_temp')
-    if not os.path.exists(coronal_temp):
-        os.system('mkdir %s' % coronal_temp)    
+    if os.path.exists(coronal_temp):
+        shutil.rmtree(coronal_temp)
+    os.system('mkdir %s' % coronal_temp)    
     for i in range(map_data.shape[2]):
         if np.nanmax(template_data[:,:,i]) != 0:        
             plt.imshow(template_data[:,:,i], cmap='gray', aspect=template_dimensions[2])
@@ -84,7 +106,8 @@ def plot_maps(template_path, map_path, threshold, stem_name, output):
     image_names = sorted(image_names, key=natural_key)
     for image in image_names:
         images.append(imageio.imread(os.path.join(saggital_temp, image)))
-    imageio.mimsave('/%s/%s_%s.gif' % (output, stem_name, 'saggital_plots'), images, duration=0.30) 
+    with atomic_output(gif_paths[0]) as tmp_path:
+        imageio.mimsave(tmp_path, images, duration=0.30) 
     # saggital_gif = os.path.join(output, stem_name + '_saggital_plots.gif')
         
     images = []
@@ -94,7 +117,8 @@ def plot_maps(template_path, map_path, threshold, stem_name, output):
     image_names = sorted(image_names, key=natural_key)
     for image in image_names:
         images.append(imageio.imread(os.path.join(axial_temp, image)))
-    imageio.mimsave('/%s/%s_%s.gif' % (output, stem_name, 'axial_plots'), images, duration=0.30)  
+    with atomic_output(gif_paths[1]) as tmp_path:
+        imageio.mimsave(tmp_path, images, duration=0.30)  
     # axial_gif = os.path.join(output, stem_name + '_axial_plots.gif')
 
     images = []
@@ -104,12 +128,14 @@ def plot_maps(template_path, map_path, threshold, stem_name, output):
     image_names = sorted(image_names, key=natural_key)
     for image in image_names:
         images.append(imageio.imread(os.path.join(coronal_temp, image)))
-    imageio.mimsave('/%s/%s_%s.gif' % (output, stem_name, 'coronal_plots'), images, duration=0.30)    
+    with atomic_output(gif_paths[2]) as tmp_path:
+        imageio.mimsave(tmp_path, images, duration=0.30)    
     # coronal_gif = os.path.join(output, stem_name + '_coronal_plots.gif')
     
     os.system('rm -r %s' % saggital_temp)
     os.system('rm -r %s' % coronal_temp)
     os.system('rm -r %s' % axial_temp)
+    manifest.record(gif_paths, inputs, params)
     
     # html_file = open('%s/%s_R2maps.html' % (output, stem_name),'w')
     # content = '<html>\n<body>\n<h1>Saggital</h1>\n<img src="%s">\n</body>\n</html>''<html>\n<body>\n<h1>Axial</h1>\n<img src="%s">\n</body>\n</html>''<html>\n<body>\n<h1>Coronal</h1>\n<img src="%s">\n</body>\n</html>' % (saggital_gif,
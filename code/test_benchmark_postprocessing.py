@@ -0,0 +1,171 @@
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+import numpy as np
+import benchmark_postprocessing as bp
+
+try:
+    import neuropythy
+except ImportError:
+    neuropythy = None
+
+try:
+    import imageio
+except ImportError:
+    imageio = None
+
+
+class TestCompareGolden(unittest.TestCase):
+
+    def setUp(self):
+
+        self.key = 'make_fsaverage|32k_fs_LR'
+        self.arrays = {'native:L_x.mgz': np.arange(4.), 'native:R_x.mgz': np.ones(4)}
+        self.golden = dict(('%s|%s' % (self.key, name), value.copy()) for name, value in self.arrays.items())
+        self.golden['plot_maps|volume24|output:a.gif'] = np.zeros(3)
+
+    def test_match(self):
+
+        self.assertEqual(bp.compare_golden(self.key, self.arrays, self.golden), [])
+        arrays = dict(self.arrays, **{'native:L_x.mgz': np.arange(4.) + 1e-8})
+        self.assertEqual(bp.compare_golden(self.key, arrays, self.golden), [])
+
+    def test_mismatch(self):
+
+        arrays = dict(self.arrays, **{'native:L_x.mgz': np.arange(4.) + 0.1})
+        self.assertEqual(bp.compare_golden(self.key, arrays, self.golden), [self.key + '|native:L_x.mgz'])
+        arrays = dict(self.arrays, **{'native:L_x.mgz': np.arange(5.)})
+        self.assertEqual(bp.compare_golden(self.key, arrays, self.golden), [self.key + '|native:L_x.mgz'])
+
+    def test_missing_output(self):
+
+        arrays = {'native:L_x.mgz': self.arrays['native:L_x.mgz']}
+        self.assertEqual(bp.compare_golden(self.key, arrays, self.golden),
+                         [self.key + '|native:R_x.mgz (missing output)'])
+        self.assertEqual(len(bp.compare_golden(self.key, {}, self.golden)), 2)
+
+    def test_unexpected_output(self):
+
+        arrays = dict(self.arrays, **{'native:L_y.mgz': np.ones(4)})
+        self.assertEqual(bp.compare_golden(self.key, arrays, self.golden),
+                         [self.key + '|native:L_y.mgz (unexpected output)'])
+
+    def test_no_golden(self):
+
+        key = 'make_fsaverage|59k_fs_LR'
+        self.assertFalse(bp.has_golden(key, self.golden))
+        self.assertEqual(bp.compare_golden(key, self.arrays, self.golden), [])
+        # A mesh name that extends another one is not mistaken for it
+        self.assertFalse(bp.has_golden('make_fsaverage|32k', self.golden))
+
+
+class TestCompareBaseline(unittest.TestCase):
+
+    def setUp(self):
+
+        self.key = bp.result_key('plot_maps', 'volume24', 4)
+        self.baseline = {self.key: {'seconds': 2., 'peak_memory_mb': 100.}}
+
+    def result(self, seconds, peak_memory_mb):
+        return {self.key: {'seconds': seconds, 'peak_memory_mb': peak_memory_mb}}
+
+    def test_within_tolerance(self):
+
+        self.assertEqual(bp.compare_baseline(self.result(2.4, 120.), self.baseline, 0.25), [])
+        self.assertEqual(bp.compare_baseline(self.result(1., 50.), self.baseline, 0.25), [])
+
+    def test_slower(self):
+
+        regressions = bp.compare_baseline(self.result(3., 100.), self.baseline, 0.25)
+        self.assertEqual(regressions, ['%s: 2.000s -> 3.000s' % self.key])
+
+    def test_bigger(self):
+
+        regressions = bp.compare_baseline(self.result(2., 200.), self.baseline, 0.25)
+        self.assertEqual(regressions, ['%s: 100.0MB -> 200.0MB' % self.key])
+
+    def test_small_memory_ignored(self):
+
+        baseline = {self.key: {'seconds': 2., 'peak_memory_mb': 0.1}}
+        self.assertEqual(bp.compare_baseline(self.result(2., 0.9), baseline, 0.25), [])
+
+    def test_not_in_baseline(self):
+
+        self.assertEqual(bp.compare_baseline(self.result(100., 1000.), {}, 0.25), [])
+
+
+class TestUpdateBaseline(unittest.TestCase):
+
+    def test_update_baseline_keeps_other_stages(self):
+
+        baseline = {'meta': {'date': 'old'}, 'results': {'a|m|4': {'seconds': 1.}, 'b|m|4': {'seconds': 2.}}}
+        report = {'meta': {'date': 'new'}, 'results': {'b|m|4': {'seconds': 3.}, 'c|m|4': {'seconds': 4.}}}
+        updated = bp.update_baseline(baseline, report)
+        self.assertEqual(updated['meta'], {'date': 'new'})
+        self.assertEqual(updated['results'], {'a|m|4': {'seconds': 1.}, 'b|m|4': {'seconds': 3.}, 'c|m|4': {'seconds': 4.}})
+        self.assertEqual(baseline['results']['b|m|4'], {'seconds': 2.})
+        self.assertEqual(bp.update_baseline({}, report)['results'], report['results'])
+
+    def test_update_golden_replaces_checked_stages(self):
+
+        golden = {'a|m|x': np.zeros(2), 'a|m|old': np.zeros(2), 'a|n|x': np.zeros(2), 'b|m|x': np.zeros(2)}
+        new_golden = {'a|m|x': np.ones(2), 'a|m|new': np.ones(2)}
+        updated = bp.update_golden(golden, new_golden)
+        self.assertEqual(sorted(updated), ['a|m|new', 'a|m|x', 'a|n|x', 'b|m|x'])
+        self.assertTrue(np.all(updated['a|m|x'] == 1))
+        self.assertTrue(np.all(updated['b|m|x'] == 0))
+
+
+class TestStages(unittest.TestCase):
+
+    def test_kernels_match_committed_golden(self):
+
+        golden = dict(np.load(os.path.join(bp.code_dir, 'benchmark_golden.npz')))
+        for stage in bp.KERNEL_STAGES:
+            for mesh in bp.MESHES:
+                key = '%s|%s' % (stage, mesh)
+                if not bp.has_golden(key, golden):
+                    continue
+                func, n_processed, labels = bp.kernel_stage(stage, mesh, bp.GOLDEN_MAP_COUNT, bp.GOLDEN_SEED)
+                arrays = {}
+                for label, output in zip(labels, func()):
+                    for i, value in enumerate(output):
+                        arrays['%s:%d' % (label, i)] = value
+                self.assertEqual(bp.compare_golden(key, arrays, golden), [])
+
+    @unittest.skipIf(neuropythy is None, 'neuropythy is not installed')
+    def test_cifti_maps_split_like_hcp(self):
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        for mesh in bp.ATLAS_ROIS:
+            paths = bp.write_cifti_maps(os.path.join(folder, mesh), mesh, 2, bp.GOLDEN_SEED)
+            image = neuropythy.load(paths[1])
+            self.assertEqual(image.shape[-1], bp.GRAYORDINATES[mesh])
+            (left, right, other) = neuropythy.hcp.cifti_split(image)
+            (field, expected_left, expected_right) = bp.synthetic_maps(mesh, 2, bp.GOLDEN_SEED)[1]
+            (left_roi, right_roi) = bp.load_atlas_roi(mesh)
+            self.assertTrue(np.allclose(np.ravel(left)[left_roi], expected_left[left_roi]))
+            self.assertTrue(np.allclose(np.ravel(right)[right_roi], expected_right[right_roi]))
+            self.assertTrue(np.all(np.isnan(np.ravel(left)[~left_roi])))
+
+    @unittest.skipIf(imageio is None, 'imageio is not installed')
+    def test_zip_images_summarized(self):
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        image = np.zeros((4, 4, 3), np.uint8)
+        image[..., 0] = 200
+        with zipfile.ZipFile(os.path.join(folder, 'diagnostics_x.html.zip'), 'w') as archive:
+            archive.writestr('index.html', '<h1>Surface</h1>')
+            archive.writestr('images/volume.png', imageio.imwrite('<bytes>', image, format='png'))
+        summary = bp.summarize_outputs([folder])
+        key = '%s:diagnostics_x.html.zip:images/volume.png' % os.path.basename(folder)
+        self.assertEqual(list(summary), [key])
+        self.assertTrue(np.allclose(summary[key], [200, 0, 0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from incremental import Manifest, MANIFEST_NAME, atomic_output, run_command, remove_stale_temporaries, temporary_path
+
+
+class TestIncremental(unittest.TestCase):
+
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+        self.input = os.path.join(self.folder, 'map.dtseries.nii')
+        self.output = os.path.join(self.folder, 'L_map.mgz')
+        self.params = {'threshold': 0.1, 'code': 'abc'}
+        self.write(self.input, 'input')
+
+    def tearDown(self):
+
+        shutil.rmtree(self.folder)
+
+    def write(self, path, content):
+
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def make_output(self, manifest=None):
+
+        # Write the output and record it the way the scripts do
+        manifest = manifest or Manifest(self.folder)
+        with atomic_output(self.output) as tmp_path:
+            self.write(tmp_path, 'output')
+        manifest.record([self.output], [self.input], self.params)
+
+    def test_up_to_date_after_record(self):
+
+        self.make_output()
+        self.assertTrue(Manifest(self.folder).up_to_date([self.output], [self.input], self.params))
+
+    def test_missing_output_or_entry(self):
+
+        self.assertFalse(Manifest(self.folder).up_to_date([self.output], [self.input], self.params))
+        self.make_output()
+        os.remove(self.output)
+        self.assertFalse(Manifest(self.folder).up_to_date([self.output], [self.input], self.params))
+
+    def test_parameter_change(self):
+
+        self.make_output()
+        params = dict(self.params, threshold=0.2)
+        self.assertFalse(Manifest(self.folder).up_to_date([self.output], [self.input], params))
+        params = dict(self.params, code='def')
+        self.assertFalse(Manifest(self.folder).up_to_date([self.output], [self.input], params))
+
+    def test_input_change(self):
+
+        self.make_output()
+        self.write(self.input, 'refitted input')
+        self.assertFalse(Manifest(self.folder).up_to_date([self.output], [self.input], self.params))
+
+    def test_extra_input(self):
+
+        self.make_output()
+        surface = os.path.join(self.folder, 'lh.sphere.reg')
+        self.write(surface, 'sphere')
+        self.assertFalse(Manifest(self.folder).up_to_date([self.output], [self.input, surface], self.params))
+
+    def test_tampered_output(self):
+
+        self.make_output()
+        self.write(self.output, 'half written')
+        self.assertFalse(Manifest(self.folder).up_to_date([self.output], [self.input], self.params))
+
+    def test_unreadable_manifest(self):
+
+        self.make_output()
+        self.write(os.path.join(self.folder, MANIFEST_NAME), '{not json')
+        manifest = Manifest(self.folder)
+        self.assertEqual(manifest.entries, {})
+        self.assertFalse(manifest.up_to_date([self.output], [self.input], self.params))
+
+    def test_disabled(self):
+
+        self.make_output()
+        manifest = Manifest(self.folder, enabled=False)
+        self.assertFalse(manifest.up_to_date([self.output], [self.input], self.params))
+        manifest.record([self.output], [self.input], dict(self.params, threshold=0.5))
+        with open(os.path.join(self.folder, MANIFEST_NAME)) as f:
+            self.assertEqual(list(json.load(f).values())[0]['params'], self.params)
+
+    def test_temporary_missing_after_block(self):
+
+        self.write(self.output, 'previous')
+        with self.assertRaises(IOError):
+            with atomic_output(self.output):
+                pass
+        with open(self.output) as f:
+            self.assertEqual(f.read(), 'previous')
+
+    def test_failed_block_discards_temporary(self):
+
+        self.write(self.output, 'previous')
+        with self.assertRaises(RuntimeError):
+            with atomic_output(self.output) as tmp_path:
+                self.write(tmp_path, 'partial')
+                run_command('exit 3')
+        self.assertFalse(os.path.exists(tmp_path))
+        with open(self.output) as f:
+            self.assertEqual(f.read(), 'previous')
+
+    def test_stale_temporaries_removed(self):
+
+        # A pid above the kernel's pid_max can never belong to a live process
+        stale = os.path.join(self.folder, '.tmp99999999_L_map.mgz')
+        self.write(stale, 'partial')
+        own = temporary_path(self.output)
+        self.write(own, 'in progress')
+        remove_stale_temporaries(self.folder)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(own))
+
+    def test_stale_temporaries_removed_by_manifest(self):
+
+        stale = os.path.join(self.folder, '.tmp99999999_L_map.mgz')
+        self.write(stale, 'partial')
+        Manifest(self.folder, enabled=False)
+        self.assertFalse(os.path.exists(stale))
+
+
+if __name__ == '__main__':
+    unittest.main()